@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+import weakref
+from contextlib import suppress
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed cache shared by every request (and every worker) on this host
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.abspath("temp"), "cache"))
+
+_locks = weakref.WeakValueDictionary()
+
+def cache_key(*parts):
+    """Stable SHA-256 key over the given parts (NUL-separated so parts cannot run together)"""
+    return hashlib.sha256("\x00".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+def key_lock(key):
+    """Per-key asyncio.Lock so concurrent identical requests compute the value only once"""
+    lock = _locks.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _locks[key] = lock
+    return lock
+
+def _entry_path(namespace, key, ext):
+    return os.path.join(CACHE_DIR, namespace, key[:2], f"{key}{ext}")
+
+def _atomic_write(path, write):
+    """Write via a unique temp file + os.replace so readers never see partial entries"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        with suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+        raise
+
+def load_json_many(namespace, keys):
+    """Return {key: value} for every key that has a cached JSON entry"""
+    hits = {}
+    for key in keys:
+        try:
+            with open(_entry_path(namespace, key, ".json"), encoding="utf-8") as f:
+                hits[key] = json.load(f)
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable cache entry {key}: {str(e)}")
+    return hits
+
+def store_json_many(namespace, items):
+    """Persist {key: value} pairs as individual JSON entries"""
+    for key, value in items.items():
+        def write(tmp_path, value=value):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+        try:
+            _atomic_write(_entry_path(namespace, key, ".json"), write)
+        except Exception as e:
+            logger.warning(f"Failed to cache entry {key}: {str(e)}")
+
+def fetch_file(namespace, key, ext, destination):
+    """Copy a cached file to destination; returns False on a cache miss"""
+    try:
+        shutil.copyfile(_entry_path(namespace, key, ext), destination)
+        return True
+    except FileNotFoundError:
+        return False
+
+def store_file(namespace, key, ext, source):
+    """Copy source into the cache under key"""
+    try:
+        _atomic_write(_entry_path(namespace, key, ext), lambda tmp_path: shutil.copyfile(source, tmp_path))
+    except Exception as e:
+        logger.warning(f"Failed to cache file {key}: {str(e)}")
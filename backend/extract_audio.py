@@ -1,7 +1,82 @@
 import asyncio
+import json
+import logging
 import os
 import shutil
 import subprocess
+from functools import lru_cache
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+WHISPER_SAMPLE_RATE = 16000  # Whisper consumes 16 kHz mono float32
+
+@lru_cache(maxsize=None)
+def has_nvenc():
+    """Checks once whether the local FFmpeg build ships the NVENC H.264 encoder."""
+    if not shutil.which("ffmpeg"):
+        return False
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=10
+        )
+        return b"h264_nvenc" in result.stdout
+    except Exception:
+        return False
+
+@lru_cache(maxsize=None)
+def has_rubberband():
+    """Checks once whether the local FFmpeg build ships the librubberband filter."""
+    if not shutil.which("ffmpeg"):
+        return False
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-filters"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=10
+        )
+        return b" rubberband " in result.stdout
+    except Exception:
+        return False
+
+def video_encoder_args():
+    """FFmpeg video encoder arguments for cases that must transcode (NVENC when available)."""
+    if has_nvenc():
+        return ["-c:v", "h264_nvenc", "-preset", "p4"]
+    return ["-c:v", "libx264", "-preset", "veryfast"]
+
+async def probe_media(video_path, timeout=5):
+    """
+    Reads audio presence and container duration with a single ffprobe call.
+
+    Returns (has_audio, duration_seconds); (False, None) if the file is unreadable.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error",
+            "-show_entries", "format=duration:stream=codec_type", "-of", "json", video_path,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+
+        try:
+            stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            logger.error(f"❌ ffprobe timed out on {video_path}")
+            return False, None
+
+        if process.returncode != 0:
+            return False, None
+
+        info = json.loads(stdout)
+        has_audio = any(stream.get("codec_type") == "audio" for stream in info.get("streams", []))
+        duration = info.get("format", {}).get("duration")
+        return has_audio, float(duration) if duration not in (None, "N/A") else None
+
+    except Exception as e:
+        logger.error(f"❌ Exception in probe_media: {e}")
+        return False, None
 
 async def extract_audio(video_path, output_audio_path):
     """Extracts audio from a video file asynchronously using FFmpeg."""
@@ -24,25 +99,55 @@ async def extract_audio(video_path, output_audio_path):
             "-acodec", codec, output_audio_path
         ]
 
-        # Run FFmpeg process asynchronously
+        # Run FFmpeg process asynchronously (only stderr is read, on failure)
         process = await asyncio.create_subprocess_exec(
-            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            *command, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
         )
 
-        stdout, stderr = await process.communicate()
+        _, stderr = await process.communicate()
 
         if process.returncode == 0:
-            print(f"✅ Audio extracted successfully: {output_audio_path}")
+            logger.info(f"✅ Audio extracted successfully: {output_audio_path}")
             return output_audio_path
         else:
-            error_message = stderr.decode().strip()
-            print(f"❌ Error extracting audio: {error_message}")
+            error_message = stderr[-1024:].decode("utf-8", "replace").strip()
+            logger.error(f"❌ Error extracting audio: {error_message}")
             return None  # Return None instead of raising an error
 
     except Exception as e:
-        print(f"❌ Exception in extract_audio: {e}")
+        logger.error(f"❌ Exception in extract_audio: {e}")
         return None  # Return None for better error handling
 
+async def extract_audio_pcm(video_path, sample_rate=WHISPER_SAMPLE_RATE):
+    """Decodes the audio track straight to mono float32 PCM in memory (no intermediate file)."""
+    try:
+        if not shutil.which("ffmpeg"):
+            raise EnvironmentError("❌ FFmpeg is not installed or not found in system PATH.")
+
+        # Raw f32le samples on stdout skip the MP3 encode + decode round-trip
+        command = [
+            "ffmpeg", "-nostdin", "-i", video_path, "-vn",
+            "-ac", "1", "-ar", str(sample_rate), "-f", "f32le", "-"
+        ]
+
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+
+        stdout, stderr = await process.communicate()
+
+        if process.returncode == 0 and stdout:
+            logger.info(f"✅ Audio decoded successfully: {len(stdout) // 4 / sample_rate:.1f}s")
+            return np.frombuffer(stdout, dtype=np.float32)
+        else:
+            error_message = stderr[-1024:].decode("utf-8", "replace").strip()
+            logger.error(f"❌ Error decoding audio: {error_message}")
+            return None
+
+    except Exception as e:
+        logger.error(f"❌ Exception in extract_audio_pcm: {e}")
+        return None
+
 def extract_audio_sync(video_path, output_audio_path):
     """Synchronous version of extract_audio() for non-async functions."""
     try:
@@ -65,16 +170,17 @@ def extract_audio_sync(video_path, output_audio_path):
         ]
 
         # Run FFmpeg process synchronously
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
 
         if result.returncode == 0:
-            print(f"✅ Audio extracted successfully: {output_audio_path}")
+            logger.info(f"✅ Audio extracted successfully: {output_audio_path}")
             return output_audio_path
         else:
-            error_message = result.stderr.decode().strip()
-            print(f"❌ Error extracting audio: {error_message}")
+            error_message = result.stderr[-1024:].decode("utf-8", "replace").strip()
+            logger.error(f"❌ Error extracting audio: {error_message}")
             return None
 
     except Exception as e:
-        print(f"❌ Exception in extract_audio_sync: {e}")
+        logger.error(f"❌ Exception in extract_audio_sync: {e}")
         return None
+
@@ -1,15 +1,16 @@
 import asyncio
 import os
-import httpx
 import logging
 from typing import List, Dict
+from translate_text import (
+    lookup_translations, store_translations, translate_uncached, TranslationServerError, TRANSLATE_BATCH_SIZE
+)
+
+__all__ = ["generate_srt", "translate_subtitles", "TRANSLATE_BATCH_SIZE"]
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-LIBRETRANSLATE_URL = os.getenv("LIBRETRANSLATE_URL", "http://127.0.0.1:5000/translate")
-MAX_TEXT_LENGTH = 500  # LibreTranslate API limit
+_inflight = {}  # Disk cache key -> Future of a translation currently being fetched
 
 async def generate_srt(segments: List[Dict], output_path: str, target_lang: str = None, source_lang: str = "auto") -> str:
     """
@@ -96,11 +97,18 @@ def _write_srt_file(segments: List[Dict], output_path: str):
         segments: List of segments with text and timing
         output_path: Path to output file
     """
-    with open(output_path, "w", encoding="utf-8") as f:
-        for i, segment in enumerate(segments, 1):
-            start = _format_time(segment["start"])
-            end = _format_time(segment["end"])
-            f.write(f"{i}\n{start} --> {end}\n{segment['text']}\n\n")
+    # Render the whole document up front and hand it to the kernel in one write
+    entries = [
+        f"{i}\n{_format_time(segment['start'])} --> {_format_time(segment['end'])}\n{segment['text']}\n\n"
+        for i, segment in enumerate(segments, 1)
+    ]
+    data = memoryview("".join(entries).encode("utf-8"))
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]  # Normally one syscall for the whole file
+    finally:
+        os.close(fd)
 
 def _format_time(seconds: float) -> str:
     """
@@ -112,21 +120,27 @@ def _format_time(seconds: float) -> str:
     Returns:
         Formatted timestamp string
     """
-    hours = int(seconds // 3600)
-    minutes = int((seconds % 3600) // 60)
-    seconds = seconds % 60
-    milliseconds = int((seconds - int(seconds)) * 1000)
-    return f"{hours:02}:{minutes:02}:{int(seconds):02},{milliseconds:03}"
+    # Integer milliseconds avoid the float truncation of (seconds - int(seconds)) * 1000
+    total_seconds, milliseconds = divmod(round(seconds * 1000), 1000)
+    minutes, secs = divmod(total_seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02}:{minutes:02}:{secs:02},{milliseconds:03}"
 
-async def translate_subtitles(texts: List[str], target_lang: str, source_lang: str = "auto", retries: int = 3) -> List[str]:
+async def translate_subtitles(texts: List[str], target_lang: str, source_lang: str = "auto", retries: int = 3, fallback_to_source: bool = False) -> List[str]:
     """
     Translate list of texts using LibreTranslate API.
     
+    Only texts missing from both the process-local LRU cache and the on-disk
+    cache are sent, once each; texts already in flight for a concurrent call
+    are awaited instead of being sent again.
+    
     Args:
         texts: List of texts to translate
         target_lang: Target language code
         source_lang: Source language code (default: "auto")
         retries: Number of retry attempts
+        fallback_to_source: Keep the original text for batches that still fail
+            after retries instead of raising
         
     Returns:
         List of translated texts
@@ -134,68 +148,55 @@ async def translate_subtitles(texts: List[str], target_lang: str, source_lang: s
     if not texts:
         return texts
 
-    # Prepare chunks respecting API limits
-    chunked_texts = []
-    for text in texts:
-        if len(text) > MAX_TEXT_LENGTH:
-            chunked_texts.extend(text[i:i+MAX_TEXT_LENGTH] for i in range(0, len(text), MAX_TEXT_LENGTH))
-        else:
-            chunked_texts.append(text)
-
-    translated_chunks = []
-
-    for attempt in range(retries):
-        async with httpx.AsyncClient(timeout=15.0) as client:
-            try:
-                response = await client.post(
-                    LIBRETRANSLATE_URL,
-                    json={
-                        "q": chunked_texts,
-                        "source": source_lang,
-                        "target": target_lang
-                    }
-                )
-                response.raise_for_status()
-                response_data = response.json()
-
-                # Handle different response formats
-                if isinstance(response_data, list):
-                    translated_chunks = [item.get("translatedText", "") for item in response_data]
-                elif isinstance(response_data, dict):
-                    if "translatedText" in response_data:
-                        translated_chunks = [response_data["translatedText"]]
-                    elif "error" in response_data:
-                        raise ValueError(f"Translation error: {response_data['error']}")
-                else:
-                    raise ValueError(f"Unexpected API response format: {response_data}")
-
-                break  # Success - exit retry loop
-
-            except httpx.HTTPStatusError as http_err:
-                logger.warning(f"HTTP error (attempt {attempt+1}/{retries}): {http_err}")
-            except httpx.RequestError as req_err:
-                logger.warning(f"Network error (attempt {attempt+1}/{retries}): {req_err}")
-            except Exception as e:
-                logger.error(f"Unexpected error (attempt {attempt+1}/{retries}): {e}")
-
-            if attempt == retries - 1:
-                raise Exception("🚨 Translation failed after multiple retries")
-
-    # Reconstruct original text order
-    translated_texts = []
-    chunk_index = 0
-    for original in texts:
-        if len(original) <= MAX_TEXT_LENGTH:
-            translated_texts.append(translated_chunks[chunk_index])
-            chunk_index += 1
-        else:
-            # Recombine chunks
-            parts = []
-            remaining_length = len(original)
-            while remaining_length > 0:
-                parts.append(translated_chunks[chunk_index])
-                chunk_index += 1
-                remaining_length -= MAX_TEXT_LENGTH
-            translated_texts.append(" ".join(parts))
-
-    return translated_texts
\ No newline at end of file
+    translations, misses, keys = await lookup_translations(texts, target_lang, source_lang)
+    if misses:
+        # Single-flight: texts another call is already translating are awaited, not re-sent
+        waiting = {text: _inflight[keys[text]] for text in misses if keys[text] in _inflight}
+        owned = [text for text in misses if text not in waiting]
+        loop = asyncio.get_running_loop()
+        for text in owned:
+            _inflight[keys[text]] = loop.create_future()
+
+        translated = [None] * len(owned)
+        try:
+            if owned:
+                translated = await translate_uncached(owned, target_lang, source_lang, retries, fallback_to_source)
+        except asyncio.CancelledError:
+            # Abandoned, not failed: cancelled futures tell waiters to fetch these texts themselves
+            for text in owned:
+                _inflight.pop(keys[text]).cancel()
+            raise
+        finally:
+            # Release the remaining waiters; None tells them the fetch really failed
+            for text, result in zip(owned, translated):
+                future = _inflight.pop(keys[text], None)
+                if future is not None:
+                    future.set_result(result)
+
+        new_entries = {}
+        for text, result in zip(owned, translated):
+            if result is None:
+                translations[text] = text  # Failed batch: fall back, never cache
+                continue
+            translations[text] = result
+            new_entries[text] = result
+        await store_translations(new_entries, keys, target_lang, source_lang)
+
+        abandoned = []
+        for text, future in waiting.items():
+            # wait() rather than await: a cancelled owner must not look like our own cancellation
+            await asyncio.wait([future])
+            if future.cancelled():
+                abandoned.append(text)
+                continue
+            result = future.result()
+            if result is None and not fallback_to_source:
+                raise TranslationServerError("🚨 Translation failed after multiple retries.")
+            translations[text] = text if result is None else result
+
+        if abandoned:
+            # The owning call was cancelled: re-check the caches and take over the fetch
+            retried = await translate_subtitles(abandoned, target_lang, source_lang, retries, fallback_to_source)
+            translations.update(zip(abandoned, retried))
+
+    return [translations[text] for text in texts]
@@ -0,0 +1,15 @@
+import os
+
+# Production server: gunicorn -c gunicorn.conf.py main:app
+# Each Uvicorn worker runs the async pipeline; requests no longer queue behind one dev server.
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+# Video jobs routinely run for minutes
+timeout = int(os.getenv("WORKER_TIMEOUT", "600"))
+graceful_timeout = 30
+
+# Import the app once in the master so code pages are shared copy-on-write.
+# The Whisper model still loads in each worker's startup hook: CUDA contexts do not survive fork().
+preload_app = True
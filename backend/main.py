@@ -1,128 +1,210 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+import logging
 import os
 import shutil
+import tempfile
+import uuid
 import asyncio
-import ffmpeg
+from itertools import groupby
+from operator import itemgetter
+from werkzeug.utils import secure_filename
 from text_to_speech import LANGUAGE_MAP
-from extract_audio import extract_audio
-from transcribe_audio import transcribe_audio
-from translate_text import translate_text
-from generate_subtitles import generate_srt
-from text_to_speech import generate_tts_segments
-from merge_audio_with_video import (
-    merge_audio_with_video, 
-    merge_audio_segments,
-    get_video_duration
-)
+from extract_audio import extract_audio_pcm, has_nvenc, probe_media
+from transcribe_audio import stream_transcription, get_model
+from generate_subtitles import generate_srt, translate_subtitles, TRANSLATE_BATCH_SIZE
+from text_to_speech import generate_tts_segments, get_tts_model
+from translate_text import close_client
+from merge_audio_with_video import build_and_mux
+
+# The application owns logging configuration; the pipeline modules only create loggers
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
-TEMP_DIR = os.path.abspath("temp")
+# Point TEMP_DIR at a tmpfs mount (e.g. /dev/shm/rtvt) to keep intermediates off disk;
+# only per-request work directories live there and each is removed when its request ends
+TEMP_DIR = os.path.abspath(os.getenv("TEMP_DIR", "temp"))
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Finished videos outlive the request, so they go to disk rather than TEMP_DIR
+OUTPUT_DIR = os.path.abspath(os.getenv("OUTPUT_DIR", "output"))
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+ALLOWED_EXTS = frozenset({".mp4", ".mkv", ".avi"})
+
+UPLOAD_COPY_BUFFER = 1 << 20  # 64x fewer read/write calls than the 16 KiB default
+
+@app.on_event("startup")
+async def detect_hardware_encoders():
+    """Probe FFmpeg for NVENC once at startup so requests never pay for it."""
+    nvenc = await asyncio.to_thread(has_nvenc)
+    logger.info(f"🎞️ NVENC encoder {'available' if nvenc else 'not available'}")
+
+@app.on_event("startup")
+async def preload_whisper_model():
+    """Load Whisper before the first request so no upload pays the warm-up."""
+    await get_model()
+
+@app.on_event("startup")
+async def preload_tts_model():
+    """Load XTTS before the first request so no TTS chunk pays the model load."""
+    await get_tts_model()
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    """Release pooled keep-alive connections to LibreTranslate."""
+    await close_client()
+
+def _save_upload(source_file, destination: str):
+    """
+    Copies an upload to disk in 1 MiB blocks (run off the event loop).
+    """
+    with open(destination, "wb") as buffer:
+        shutil.copyfileobj(source_file, buffer, UPLOAD_COPY_BUFFER)
+
+_segment_timing = itemgetter("start", "end")
+
 def _group_segments_into_chunks(segments: list) -> list:
     """
     Groups segments into timing-preserved chunks for TTS generation.
     """
-    chunks = []
-    current_chunk = None
-    
-    for segment in segments:
-        if not current_chunk:
-            current_chunk = {
-                "texts": [segment["text"]],
-                "start": segment["start"],
-                "end": segment["end"]
+    # Consecutive segments with identical timing form one chunk
+    return [
+        {"texts": [segment["text"] for segment in group], "start": start, "end": end}
+        for (start, end), group in groupby(segments, key=_segment_timing)
+    ]
+
+async def _translate_and_synthesize(chunks: list, start_index: int, source_language, target_language: str, output_dir: str, translations: dict):
+    """
+    Translates one batch of chunks, then synthesizes it (one pipeline stage per batch).
+
+    translations maps each text of the request to the (task, position) that
+    translates it, so a line repeated across batches is only sent once.
+    """
+    if source_language == target_language:
+        # Speech is already in the target language: only re-voice it
+        return chunks, await generate_tts_segments(chunks, output_dir, target_language, start_index)
+
+    texts = [" ".join(chunk["texts"]) for chunk in chunks]
+    new_texts = [text for text in dict.fromkeys(texts) if text not in translations]
+    if new_texts:
+        # Registered before the first await, so later batches always see these texts
+        task = asyncio.ensure_future(
+            translate_subtitles(new_texts, target_language, source_language or "auto", fallback_to_source=True)
+        )
+        for position, text in enumerate(new_texts):
+            translations[text] = (task, position)
+
+    try:
+        translated_texts = [(await translations[text][0])[translations[text][1]] for text in texts]
+        translated_chunks = [
+            {
+                "texts": [str(text).replace("\n", " ").strip()[:500]],
+                "start": chunk["start"],
+                "end": chunk["end"]
             }
-        else:
-            if segment["start"] == current_chunk["start"] and segment["end"] == current_chunk["end"]:
-                current_chunk["texts"].append(segment["text"])
-            else:
-                chunks.append(current_chunk)
-                current_chunk = {
-                    "texts": [segment["text"]],
-                    "start": segment["start"],
-                    "end": segment["end"]
-                }
-    
-    if current_chunk:
-        chunks.append(current_chunk)
-        
-    return chunks
+            for chunk, text in zip(chunks, translated_texts)
+        ]
+    except Exception as e:
+        logger.warning(f"⚠️ Translation error: {e}")
+        translated_chunks = chunks
+
+    tts_paths = await generate_tts_segments(translated_chunks, output_dir, target_language, start_index)
+    return translated_chunks, tts_paths
 
 @app.post("/process_video")
 async def process_video(
     video: UploadFile = File(...), 
     target_language: str = Query("hi", description="Target language for translation and TTS")
 ):
-    video_path = None
-    audio_path = None
-    srt_path_en = None
-    srt_path_translated = None
-    merged_tts_path = None
-    final_video_no_audio = None
-    final_dubbed_video = None
-
-    SUPPORTED_LANGUAGES = list(LANGUAGE_MAP.keys())
-    if target_language not in SUPPORTED_LANGUAGES:
+    work_dir = None
+    srt_en_task = None
+    batch_tasks = []
+    translations = {}  # Text -> (translate task, position); shared by every batch of the request
+
+    if target_language not in LANGUAGE_MAP:
         raise HTTPException(
             status_code=400,
-            detail=f"Unsupported target language. Supported: {SUPPORTED_LANGUAGES}"
+            detail=f"Unsupported target language. Supported: {sorted(LANGUAGE_MAP)}"
         )
 
     try:
-        # Validate and save video
-        allowed_extensions = (".mp4", ".mkv", ".avi")
-        if not video.filename.lower().endswith(allowed_extensions):
+        # Validate and save video; basename() drops any client-supplied directories
+        _, ext = os.path.splitext(os.path.basename(video.filename or ""))
+        if ext.lower() not in ALLOWED_EXTS:
             raise HTTPException(status_code=400, detail="Invalid file format. Supported formats: MP4, MKV, AVI")
 
-        video_path = os.path.join(TEMP_DIR, video.filename)
-        with open(video_path, "wb") as buffer:
-            shutil.copyfileobj(video.file, buffer)
+        # Never let the client-supplied name escape TEMP_DIR or reach FFmpeg unsanitized
+        filename = secure_filename(video.filename)
+        if not filename:
+            raise HTTPException(status_code=400, detail="Invalid file name")
+
+        # Intermediates live in a per-request directory that is removed as a whole
+        work_dir = tempfile.TemporaryDirectory(prefix="job_", dir=TEMP_DIR)
+        video_path = os.path.join(work_dir.name, filename)
+        await asyncio.to_thread(_save_upload, video.file, video_path)
+        # Every derived file name shares this stem; compute it once
+        stem = os.path.splitext(video_path)[0]
+        lang_stem = f"{stem}_{target_language}"
+
+        # One ffprobe answers both questions; reject unreadable or silent uploads early
+        has_audio, video_duration = await probe_media(video_path)
+        if not has_audio:
+            raise HTTPException(status_code=400, detail="Uploaded file has no readable audio stream")
+        if video_duration is None:
+            raise HTTPException(status_code=400, detail="Could not read the video duration")
 
-        # Extract audio
-        audio_path = video_path.rsplit(".", 1)[0] + ".mp3"
-        if not await extract_audio(video_path, audio_path):
+        # Decode audio to 16 kHz PCM in memory for Whisper
+        audio = await extract_audio_pcm(video_path)
+        if audio is None:
             raise HTTPException(status_code=500, detail="Audio extraction failed")
 
-        # Get video duration
-        video_duration = await get_video_duration(video_path)
+        # Transcribe, translate and synthesize as one stream: each batch of chunks is
+        # handed to translation + TTS as soon as Whisper has decoded it
+        segments = []
+        batch_segments = []
+        batch_chunk_count = 0
+        source_language = None
+
+        def start_batch(batch, start_index):
+            batch_tasks.append(asyncio.ensure_future(_translate_and_synthesize(
+                _group_segments_into_chunks(batch), start_index, source_language,
+                target_language, work_dir.name, translations
+            )))
+
+        stream = stream_transcription(audio)
+        try:
+            async for source_language, segment in stream:
+                segments.append(segment)
+                # A new timing starts a new chunk; a full batch is flushed before it
+                if not batch_segments or _segment_timing(segment) != _segment_timing(batch_segments[-1]):
+                    if batch_chunk_count == TRANSLATE_BATCH_SIZE:
+                        start_batch(batch_segments, len(batch_tasks) * TRANSLATE_BATCH_SIZE)
+                        batch_segments = []
+                        batch_chunk_count = 0
+                    batch_chunk_count += 1
+                batch_segments.append(segment)
+        except Exception as e:
+            logger.error(f"Transcription error: {e}")
+            raise HTTPException(status_code=500, detail="Audio transcription failed")
+        finally:
+            await stream.aclose()
 
-        # Transcribe audio
-        segments = await transcribe_audio(audio_path)
         if not segments:
             raise HTTPException(status_code=500, detail="Audio transcription failed")
+        start_batch(batch_segments, len(batch_tasks) * TRANSLATE_BATCH_SIZE)
 
-        # Generate English subtitles
-        srt_path_en = video_path.rsplit(".", 1)[0] + "_en.srt"
-        await generate_srt(segments, srt_path_en)
+        # Write English subtitles in the background; both SRTs are collected together below
+        srt_path_en = f"{stem}_en.srt"
+        srt_en_task = asyncio.ensure_future(generate_srt(segments, srt_path_en))
 
-        # Translate segments
-        translated_chunks = []
-        original_chunks = _group_segments_into_chunks(segments)
-        
-        for chunk in original_chunks:
-            try:
-                combined_text = " ".join(chunk["texts"])
-                translation_result = await translate_text(combined_text, target_language)
-                translated_text = translation_result["translated_text"]
-                
-                if isinstance(translated_text, list):
-                    translated_text = " ".join([str(t) for t in translated_text])
-                
-                translated_text = str(translated_text).replace("\n", " ").strip()[:500]
-
-                translated_chunks.append({
-                    "texts": [translated_text],
-                    "start": chunk["start"],
-                    "end": chunk["end"]
-                })
-            except Exception as e:
-                print(f"⚠️ Translation error: {e}")
-                translated_chunks.append(chunk)
+        results = await asyncio.gather(*batch_tasks)
+        translated_chunks = [chunk for batch_chunks, _ in results for chunk in batch_chunks]
+        segment_tts_paths = [path for _, batch_paths in results for path in batch_paths]
 
         # Generate translated subtitles
-        srt_path_translated = video_path.rsplit(".", 1)[0] + f"_{target_language}.srt"
+        srt_path_translated = f"{lang_stem}.srt"
         translated_segments = []
         for chunk in translated_chunks:
             translated_segments.append({
@@ -130,36 +212,23 @@ async def process_video(
                 "start": chunk["start"],
                 "end": chunk["end"]
             })
-        await generate_srt(translated_segments, srt_path_translated)
+        await asyncio.gather(srt_en_task, generate_srt(translated_segments, srt_path_translated))
 
-        # Generate TTS segments
-        segment_tts_paths = await generate_tts_segments(
-            translated_chunks,
-            TEMP_DIR,
-            target_language
-        )
+        if not segment_tts_paths:
+            raise HTTPException(status_code=500, detail="TTS generation failed")
 
-        # Merge audio segments with SRT timing
-        if segment_tts_paths:
-            merged_tts_path = video_path.rsplit(".", 1)[0] + f"_{target_language}_merged.mp3"
-            await merge_audio_segments(
-                audio_segments=[seg[0] for seg in segment_tts_paths],
-                srt_path=srt_path_translated,
-                video_duration=video_duration,
-                output_audio=merged_tts_path
-            )
-
-        # Create video without audio
-        final_video_no_audio = video_path.rsplit(".", 1)[0] + "_no_audio.mp4"
-        (
-            ffmpeg.input(video_path)
-            .output(final_video_no_audio, vcodec='copy', an=None)
-            .run(overwrite_output=True, quiet=True)
+        # Mix the TTS segments in memory and mux them in one FFmpeg call (AAC once, video copied)
+        # A per-job prefix keeps uploads that share a file name from overwriting each other
+        final_dubbed_video = os.path.join(
+            OUTPUT_DIR, f"{uuid.uuid4().hex}_{os.path.basename(lang_stem)}_dubbed.mp4"
         )
-
-        # Merge TTS audio with video
-        final_dubbed_video = video_path.rsplit(".", 1)[0] + f"_{target_language}_dubbed.mp4"
-        if not await merge_audio_with_video(final_video_no_audio, merged_tts_path, final_dubbed_video):
+        if not await build_and_mux(
+            video_path=video_path,
+            audio_segments=[seg[0] for seg in segment_tts_paths],
+            srt_path=srt_path_translated,
+            video_duration=video_duration,
+            final_video=final_dubbed_video
+        ):
             raise HTTPException(status_code=500, detail="Failed to merge audio with video")
 
         return {
@@ -169,12 +238,7 @@ async def process_video(
                     "english": srt_path_en, 
                     target_language: srt_path_translated
                 },
-                "audio": {
-                    "original": audio_path, 
-                    "merged_tts": merged_tts_path
-                },
                 "videos": {
-                    "without_audio": final_video_no_audio,
                     "dubbed": final_dubbed_video
                 }
             }
@@ -185,18 +249,18 @@ async def process_video(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Processing error: {str(e)}")
     finally:
+        # Stop batches and their translations abandoned by an error, then let pending
+        # work settle so nothing races the directory removal or outlives the request
+        translate_tasks = {task for task, _position in translations.values()}
+        for task in (*batch_tasks, *translate_tasks):
+            task.cancel()
+        pending = [task for task in (srt_en_task, *batch_tasks, *translate_tasks) if task]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
         # Cleanup temporary files
-        def safe_remove(path):
-            if path and os.path.exists(path):
-                try:
-                    os.remove(path)
-                except Exception as e:
-                    print(f"⚠️ Cleanup error: {e}")
-
-        cleanup_files = [
-            video_path, audio_path, srt_path_en, srt_path_translated,
-            merged_tts_path, final_video_no_audio
-        ] + [seg[0] for seg in (segment_tts_paths or []) if seg and seg[0]]
-
-        for file in cleanup_files:
-            safe_remove(file)
\ No newline at end of file
+        if work_dir:
+            try:
+                await asyncio.to_thread(work_dir.cleanup)
+            except Exception as e:
+                logger.warning(f"⚠️ Cleanup error: {e}")
\ No newline at end of file
@@ -1,25 +1,74 @@
 import asyncio
-import ffmpeg
+import math
 import os
-import uuid
 import subprocess
 import logging
 import pysrt
-from itertools import chain
+from collections import OrderedDict
+from functools import lru_cache
 import shutil
+import tempfile
+import numpy as np
+import soundfile as sf
+from extract_audio import video_encoder_args
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-TEMP_DIR = os.path.abspath("temp")
+TEMP_DIR = os.path.abspath(os.getenv("TEMP_DIR", "temp"))
+MIX_SAMPLE_RATE = 24000  # XTTS v2 native rate, so its segments need no resampling
+TEMPO_TOLERANCE = 0.02  # Tempo changes within ±2% are inaudible and skipped
+PROBE_CACHE_SIZE = 512  # Bounded (probe, path, mtime, size) -> result entries
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+_probe_cache = OrderedDict()
+
+async def _cached_probe(kind, media_path, probe):
+    """Memoize a probe on (path, mtime, size) so an unchanged file is never probed twice"""
+    stat = os.stat(media_path)
+    key = (kind, media_path, stat.st_mtime_ns, stat.st_size)
+    if key in _probe_cache:
+        _probe_cache.move_to_end(key)
+        return _probe_cache[key]
+
+    value = await probe(media_path)
+    _probe_cache[key] = value
+    if len(_probe_cache) > PROBE_CACHE_SIZE:
+        _probe_cache.popitem(last=False)
+    return value
+
+async def probe_duration(media_path):
+    """Read container duration in seconds (cached per file version)"""
+    return await _cached_probe("duration", media_path, _probe_duration)
+
+async def _probe_duration(media_path):
+    """Read container duration in seconds with a direct ffprobe call"""
+    stdout = await run_command([
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "csv=p=0",
+        media_path
+    ], capture_stdout=True)
+    return float(stdout.decode().strip())
+
+async def probe_audio_codec(media_path):
+    """Return the codec name of the first audio stream (e.g. "aac"), or "" if there is none"""
+    return await _cached_probe("audio_codec", media_path, _probe_audio_codec)
+
+async def _probe_audio_codec(media_path):
+    """First audio stream's codec name via a direct ffprobe call"""
+    stdout = await run_command([
+        "ffprobe", "-v", "error",
+        "-select_streams", "a:0",
+        "-show_entries", "stream=codec_name",
+        "-of", "csv=p=0",
+        media_path
+    ], capture_stdout=True)
+    return stdout.decode().strip()
+
 async def get_video_duration(video_path):
     """Get video duration in seconds"""
     try:
-        probe = await asyncio.to_thread(ffmpeg.probe, video_path)
-        return float(probe["format"]["duration"])
+        return await probe_duration(video_path)
     except Exception as e:
         logger.error(f"Failed to get video duration: {str(e)}")
         raise
@@ -27,24 +76,37 @@ async def get_video_duration(video_path):
 async def merge_audio_segments(audio_segments, srt_path, video_duration, output_audio):
     """Merge audio segments with proper timing from SRT file"""
     try:
-        # Validate inputs
-        if not audio_segments or not os.path.exists(srt_path):
+        pcm = await mix_audio_segments(audio_segments, srt_path, video_duration)
+        await run_command([
+            "ffmpeg", "-y",
+            "-f", "s16le", "-ar", str(MIX_SAMPLE_RATE), "-ac", "1",
+            "-i", "pipe:0",
+            *_audio_codec_args(output_audio),
+            output_audio
+        ], input=pcm.tobytes())
+
+        return output_audio
+
+    except Exception as e:
+        logger.error(f"Audio merge failed: {str(e)}", exc_info=True)
+        raise
+
+async def mix_audio_segments(audio_segments, srt_path, video_duration):
+    """Mix audio segments at their SRT timings into mono int16 PCM at MIX_SAMPLE_RATE"""
+    try:
+        # Validate inputs (pysrt.open raises for a missing SRT, no separate stat needed)
+        if not audio_segments:
             raise ValueError("Invalid audio segments or SRT path")
 
         subs = pysrt.open(srt_path)
         if len(audio_segments) != len(subs):
             raise ValueError("Audio segments and subtitles count mismatch")
 
-        inputs = []
-        temp_files = []
-        filter_chains = []
+        placements = []
 
         # Process each segment with proper timing
         for idx, (seg_path, sub) in enumerate(zip(audio_segments, subs)):
             seg_path = seg_path[0] if isinstance(seg_path, tuple) else seg_path
-            if not os.path.exists(seg_path):
-                logger.warning(f"Skipping missing segment {idx}: {seg_path}")
-                continue
 
             # Calculate timing from SRT (in seconds)
             start = sub.start.ordinal / 1000
@@ -55,117 +117,162 @@ async def merge_audio_segments(audio_segments, srt_path, video_duration, output_
                 logger.warning(f"Skipping invalid duration {duration}s for segment {idx}")
                 continue
 
-            processed = os.path.join(TEMP_DIR, f"seg_{uuid.uuid4().hex}.wav")
-            inputs.extend(["-i", seg_path])
-            
-            # Create filter chain for this segment
-            filter_chains.append(
-                f"[{len(inputs)//2 - 1}:a]atrim=0:{duration},"
-                f"asetpts=N/SR/TB,"
-                f"adelay={int(start*1000)}|{int(start*1000)},"
-                f"apad=whole_dur={video_duration}[a{idx}]"
-            )
-            temp_files.append(processed)
+            placements.append((seg_path, start, duration))
 
-        if not filter_chains:
-            raise ValueError("No valid audio segments to merge")
+        # Decode all segments concurrently (libsndfile releases the GIL), bounded to the core count
+        semaphore = asyncio.Semaphore(os.cpu_count() or 4)
 
-        # Build final filtergraph
-        mix_inputs = "".join([f"[a{i}]" for i in range(len(filter_chains))])
-        filtergraph = ";".join(filter_chains) + f";{mix_inputs}amix=inputs={len(filter_chains)}:duration=longest[outa]"
+        async def _decode(seg_path):
+            async with semaphore:
+                try:
+                    return await asyncio.to_thread(_read_pcm, seg_path, MIX_SAMPLE_RATE)
+                except Exception as e:
+                    # Missing or unreadable clips are skipped, found by the decode itself
+                    logger.warning(f"Skipping unreadable segment {seg_path}: {str(e)}")
+                    return None
 
-        # Execute FFmpeg
-        await run_command([
-            "ffmpeg", "-y",
-            *inputs,
-            "-filter_complex", filtergraph,
-            "-map", "[outa]",
-            "-c:a", "libmp3lame", "-b:a", "192k",
-            output_audio
-        ])
+        decoded = await asyncio.gather(*[_decode(seg_path) for seg_path, _, _ in placements])
+        placements = [
+            (samples, start, duration)
+            for samples, (_, start, duration) in zip(decoded, placements)
+            if samples is not None
+        ]
 
-        return output_audio
+        if not placements:
+            raise ValueError("No valid audio segments to merge")
+
+        # Lay every segment into one PCM timeline
+        return await asyncio.to_thread(_mix_segments, placements, video_duration)
 
     except Exception as e:
-        logger.error(f"Audio merge failed: {str(e)}", exc_info=True)
+        logger.error(f"Audio mix failed: {str(e)}", exc_info=True)
         raise
-    finally:
-        cleanup(temp_files)
 
-async def run_command(cmd):
-    """Robust command executor with full diagnostics"""
+def _audio_codec_args(output_audio):
+    """AAC for .m4a/.aac outputs (stream-copied by the final mux), PCM for .wav scratch files, MP3 otherwise"""
+    ext = os.path.splitext(output_audio)[1].lower()
+    if ext in (".m4a", ".aac"):
+        return ["-c:a", "aac", "-b:a", "192k"]
+    if ext == ".wav":
+        return ["-c:a", "pcm_s16le"]
+    return ["-c:a", "libmp3lame", "-b:a", "192k"]
+
+def _read_pcm(path, sample_rate):
+    """Decode an audio file to mono int16 samples at sample_rate"""
+    samples, rate = sf.read(path, dtype="int16", always_2d=True)
+    samples = samples.mean(axis=1) if samples.shape[1] > 1 else samples[:, 0]
+    if rate != sample_rate:
+        count = int(round(len(samples) * sample_rate / rate))
+        samples = np.interp(np.arange(count) * (rate / sample_rate), np.arange(len(samples)), samples)
+    return samples.astype(np.int16)
+
+def _mix_segments(placements, video_duration):
+    """Place decoded (samples, start, duration) segments on a silent timeline of video_duration seconds"""
+    total = int(math.ceil(video_duration * MIX_SAMPLE_RATE))
+    mix = np.zeros(total, dtype=np.int32)
+    for samples, start, duration in placements:
+        samples = samples[:int(duration * MIX_SAMPLE_RATE)]
+        offset = int(start * MIX_SAMPLE_RATE)
+        end = min(offset + len(samples), total)
+        if end > offset:
+            mix[offset:end] += samples[:end - offset]
+    return np.clip(mix, -32768, 32767).astype(np.int16)
+
+async def run_command(cmd, input=None, capture_stdout=False):
+    """Robust command executor with full diagnostics (stdout is returned only if captured)"""
     logger.debug(f"Executing: {' '.join(cmd)}")
     proc = await asyncio.create_subprocess_exec(
         *cmd,
-        stdout=subprocess.PIPE,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
         stderr=subprocess.PIPE
     )
-    stdout, stderr = await proc.communicate()
+    stdout, stderr = await proc.communicate(input)
     
     if proc.returncode != 0:
-        error_msg = stderr.decode().strip()
+        # Only the tail matters (FFmpeg prints the failure last); skip decoding the whole log
+        error_msg = stderr[-1024:].decode("utf-8", "replace").strip()
         logger.error(f"Command failed ({proc.returncode}): {error_msg}")
         raise RuntimeError(f"FFmpeg error: {error_msg}")
     
     return stdout
 
 def cleanup(files):
-    """Atomic file cleanup with existence checks"""
-    for f in files:
+    """Best-effort cleanup; files are unlinked directly, without a stat first"""
+    for f in set(filter(None, files)):
         try:
-            if os.path.exists(f):
-                if os.path.isdir(f):
-                    shutil.rmtree(f)
-                else:
-                    os.remove(f)
-        except Exception as e:
-            logger.warning(f"Cleanup error for {f}: {str(e)}")
-
-async def adjust_audio_duration(segment_path, target_duration):
-    """Adjust audio duration safely"""
-    try:
-        if not os.path.exists(segment_path):
-            raise FileNotFoundError(f"Audio not found: {segment_path}")
-
-        probe = await asyncio.to_thread(ffmpeg.probe, segment_path)
-        current_duration = float(probe["format"]["duration"])
-        
-        if current_duration <= 0.01 or target_duration <= 0.01:
-            raise ValueError(f"Invalid durations: {current_duration}s -> {target_duration}s")
-
-        speed_factor = max(0.5, min(2.0, current_duration / target_duration))
-        
-        adjusted_path = os.path.join(TEMP_DIR, f"adj_{uuid.uuid4().hex}.mp3")
-        await run_command([
-            "ffmpeg", "-y", "-i", segment_path,
-            "-af", f"atempo={speed_factor:.3f}",
-            "-c:a", "libmp3lame", "-b:a", "192k",
-            adjusted_path
-        ])
-        
-        return adjusted_path
+            os.unlink(f)
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            # unlink() refuses directories, so only stat on this slow path
+            if os.path.isdir(f):
+                shutil.rmtree(f, ignore_errors=True)
+            else:
+                logger.warning(f"Cleanup error for {f}: {str(e)}")
 
-    except Exception as e:
-        logger.error(f"Duration adjustment failed: {str(e)}", exc_info=True)
-        raise
+@lru_cache(maxsize=256)
+def tempo_filter(speed_factor, use_rubberband):
+    """FFmpeg tempo filter for a ratio; callers round it so similar ratios share an entry"""
+    if use_rubberband:
+        return f"rubberband=tempo={speed_factor}"
+    # atempo stages are limited to [0.5, 2.0]: split the ratio into equal in-range stages
+    stages = max(1, math.ceil(abs(math.log2(speed_factor))))
+    return ",".join([f"atempo={speed_factor ** (1 / stages):.6f}"] * stages)
 
-async def merge_audio_with_video(video_no_audio, merged_audio_path, final_video):
-    """Merge audio and video with sync protection"""
+async def merge_audio_with_video(video_path, merged_audio, final_video):
+    """
+    Mux the source video track with the dubbed audio (original audio is never mapped).
+
+    merged_audio is an audio file, or the PCM array from mix_audio_segments,
+    which is piped straight into the mux so no audio track file is written.
+    """
     try:
-        if not all(os.path.exists(f) for f in [video_no_audio, merged_audio_path]):
+        if isinstance(merged_audio, np.ndarray):
+            pcm = merged_audio.tobytes()
+            audio_input = ["-f", "s16le", "-ar", str(MIX_SAMPLE_RATE), "-ac", "1", "-i", "pipe:0"]
+            input_files = [video_path]
+        else:
+            pcm = None
+            audio_input = ["-i", merged_audio]
+            input_files = [video_path, merged_audio]
+
+        if not all(os.path.exists(f) for f in input_files):
             raise FileNotFoundError("Missing input files")
 
-        await run_command([
-            "ffmpeg", "-y",
-            "-i", video_no_audio,
-            "-i", merged_audio_path,
-            "-c:v", "copy",
-            "-c:a", "aac",
-            "-b:a", "192k",
-            "-movflags", "+faststart",
-            "-shortest",
-            final_video
-        ])
+        # AAC audio is muxed as-is; anything else is encoded to AAC exactly once here
+        if pcm is None and await probe_audio_codec(merged_audio) == "aac":
+            audio_args = ["-c:a", "copy"]
+        else:
+            audio_args = ["-c:a", "aac", "-b:a", "192k"]
+
+        # Fragmented MP4 puts an empty moov up front and writes in one linear pass;
+        # faststart would rewrite the whole file to move the moov. MP4/MOV muxer only.
+        is_mp4 = os.path.splitext(final_video)[1].lower() in (".mp4", ".m4v", ".mov")
+        container_args = ["-movflags", "+frag_keyframe+empty_moov+default_base_moof"] if is_mp4 else []
+
+        def mux_command(video_args):
+            return [
+                "ffmpeg", "-y",
+                "-i", video_path,
+                *audio_input,
+                "-map", "0:v:0",
+                "-map", "1:a:0",
+                *video_args,
+                *audio_args,
+                *container_args,
+                "-shortest",
+                final_video
+            ]
+
+        # Stream-copy the frames; transcode only if the output container rejects the codec
+        try:
+            await run_command(mux_command(["-c:v", "copy"]), input=pcm)
+        except RuntimeError:
+            logger.warning("Video stream copy failed, re-encoding video track")
+            # The encoder probe is a blocking subprocess on its first call, so keep it off the loop
+            video_args = await asyncio.to_thread(video_encoder_args)
+            await run_command(mux_command(video_args), input=pcm)
 
         logger.info(f"✅ Final video created: {final_video}")
         return final_video
@@ -174,29 +281,36 @@ async def merge_audio_with_video(video_no_audio, merged_audio_path, final_video)
         logger.error(f"Video merge failed: {str(e)}", exc_info=True)
         raise
 
+async def build_and_mux(video_path, audio_segments, srt_path, video_duration, final_video):
+    """Mix the segments and mux them over the video in one FFmpeg call (no audio track file)"""
+    pcm = await mix_audio_segments(audio_segments, srt_path, video_duration)
+    return await merge_audio_with_video(video_path, pcm, final_video)
+
 async def process_video(video_path, audio_segments, srt_path, output_video):
     """Complete processing pipeline example"""
     try:
         # Get video duration
         duration = await get_video_duration(video_path)
-        
-        # Process audio
-        merged_audio = os.path.join(TEMP_DIR, "merged_audio.mp3")
-        await merge_audio_segments(
-            audio_segments=audio_segments,
-            srt_path=srt_path,
-            video_duration=duration,
-            output_audio=merged_audio
-        )
-        
-        # Merge with video
-        await merge_audio_with_video(
-            video_no_audio=video_path,
-            merged_audio_path=merged_audio,
-            final_video=output_video
-        )
-        
+
+        # Per-call scratch directory: concurrent calls never share a file and one rmtree cleans up
+        with tempfile.TemporaryDirectory(prefix="merge_", dir=TEMP_DIR) as scratch_dir:
+            # Process audio (AAC, so the mux below stream-copies it)
+            merged_audio = os.path.join(scratch_dir, "merged_audio.m4a")
+            await merge_audio_segments(
+                audio_segments=audio_segments,
+                srt_path=srt_path,
+                video_duration=duration,
+                output_audio=merged_audio
+            )
+
+            # Merge with video
+            await merge_audio_with_video(
+                video_path=video_path,
+                merged_audio=merged_audio,
+                final_video=output_video
+            )
+
         return output_video
     except Exception as e:
         logger.error(f"Video processing failed: {str(e)}")
-        raise
\ No newline at end of file
+        raise
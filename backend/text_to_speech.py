@@ -1,82 +1,174 @@
 import httpx
 import asyncio
-import subprocess
+import hashlib
+import threading
 import torch
 import os
-from pydub import AudioSegment
+import logging
+import soundfile as sf
+from types import MappingProxyType
+from TTS.api import TTS
+import disk_cache
+from extract_audio import has_rubberband
+from merge_audio_with_video import tempo_filter, TEMPO_TOLERANCE
+from translate_text import detect_language, TranslationError
 
-# LibreTranslate endpoint
-LIBRETRANSLATE_URL = "http://127.0.0.1:5000/detect"
+logger = logging.getLogger(__name__)
 
 # Speaker WAV file path (must be a real file)
 SPEAKER_WAV = "sample_voice/sample_voice.wav"  # Update this path
 
-# Language mapping for Coqui TTS
-LANGUAGE_MAP = {
+XTTS_MODEL = "tts_models/multilingual/multi-dataset/xtts_v2"
+_tts_model = None  # Loaded once per process, shared by every synthesis
+_tts_model_lock = None  # Created on the running loop, not at import (preload_app forks)
+_inference_lock = threading.Lock()  # One XTTS instance must not run two syntheses at once
+_speaker_latents = None  # (gpt_cond_latent, speaker_embedding) for SPEAKER_WAV, computed once
+_speaker_digest = None  # Content digest of SPEAKER_WAV, so a replaced voice file misses the TTS cache
+
+# Chunks in the TTS stage at once, shared by every request in the process
+# (cache hits overlap freely; inference on the single model is serialized)
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "3"))
+# Speed fits are CPU-bound and run outside the TTS slots, one per core
+SPEED_FIT_CONCURRENCY = os.cpu_count() or 4
+_semaphores = {}
+
+# Language mapping for Coqui TTS (read-only: shared by every request)
+LANGUAGE_MAP = MappingProxyType({
     "en": "en", "hi": "hi", "bn": "bn", "ta": "ta",
     "te": "te", "mr": "mr", "gu": "gu", "pa": "pa",
     "kn": "kn", "ml": "ml"
-}
+})
 
-async def detect_language(text):
-    """Detects language using LibreTranslate."""
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(LIBRETRANSLATE_URL, json={"q": text})
-            response.raise_for_status()
-            result = response.json()
+def _load_tts_model():
+    """Loads XTTS v2 once, on the GPU when available, and conditions it on the speaker."""
+    if torch.cuda.is_available():
+        # TF32 matmuls on Ampere+; the precision loss is inaudible
+        torch.backends.cuda.matmul.allow_tf32 = True
+        model = TTS(XTTS_MODEL).to("cuda")
+    else:
+        model = TTS(XTTS_MODEL).to("cpu")
+
+    # Not yet shared, so no lock needed; a missing speaker file is reported per synthesis
+    if os.path.exists(SPEAKER_WAV):
+        _speaker_wav_digest()
+        _speaker_conditioning(model.synthesizer.tts_model)
+    return model
+
+def _speaker_conditioning(xtts):
+    """Runs the speaker encoder on SPEAKER_WAV once; every synthesis reuses the latents."""
+    global _speaker_latents
+    if _speaker_latents is None:
+        with torch.inference_mode():
+            _speaker_latents = xtts.get_conditioning_latents(audio_path=[SPEAKER_WAV])
+    return _speaker_latents
 
-            # Ensure result is correctly formatted
-            if isinstance(result, list) and result:
-                result = result[0]  # Extract first element if it's a list
+def _speaker_wav_digest():
+    """Hashes SPEAKER_WAV's contents once per process, like the speaker latents."""
+    global _speaker_digest
+    if _speaker_digest is None:
+        digest = hashlib.sha256()
+        with open(SPEAKER_WAV, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        _speaker_digest = digest.hexdigest()
+    return _speaker_digest
 
-            detected_lang = result.get("language", "en") if isinstance(result, dict) else "en"
-            return detected_lang
+async def get_tts_model():
+    """Loads the XTTS model asynchronously if not already loaded."""
+    global _tts_model, _tts_model_lock
+    if _tts_model is None:
+        if _tts_model_lock is None:
+            _tts_model_lock = asyncio.Lock()
+        async with _tts_model_lock:
+            if _tts_model is None:
+                logger.info("⏳ Loading XTTS v2 model...")
+                _tts_model = await asyncio.to_thread(_load_tts_model)
+                logger.info("✅ XTTS v2 model loaded.")
+    return _tts_model
 
-        except httpx.RequestError as e:
-            print(f"🚨 Language detection failed: {e}")
-            return "en"
+def _synthesize_to_file(model, text, language, output_audio_path):
+    """Runs one in-process synthesis (called from a worker thread)."""
+    xtts = model.synthesizer.tts_model
+    with _inference_lock:
+        gpt_cond_latent, speaker_embedding = _speaker_conditioning(xtts)
+        # inference_mode: no autograd bookkeeping for a model that is never trained here
+        with torch.inference_mode():
+            result = xtts.inference(
+                text,
+                language,
+                gpt_cond_latent,
+                speaker_embedding,
+                enable_text_splitting=True
+            )
+    sf.write(output_audio_path, result["wav"], xtts.config.audio.output_sample_rate)
+
+async def _detect_or_default(text):
+    """Detects language via translate_text's memoized helper, falling back to English"""
+    try:
+        return await detect_language(text)
+    except (TranslationError, httpx.HTTPError, ValueError) as e:
+        logger.warning(f"🚨 Language detection failed: {e}")
+        return "en"
 
-async def generate_tts_segments(chunks: list, output_dir: str, target_language: str) -> list:
+def _get_semaphore(name, limit):
+    """Create shared semaphores lazily so they bind to the running event loop"""
+    if name not in _semaphores:
+        _semaphores[name] = asyncio.Semaphore(limit)
+    return _semaphores[name]
+
+async def generate_tts_segments(chunks: list, output_dir: str, target_language: str, start_index: int = 0) -> list:
     """
     Generate TTS audio for complete subtitle chunks
     Args:
         chunks: List of {'texts': list, 'start': float, 'end': float}
         output_dir: Output directory
         target_language: Target language code
+        start_index: Index of the first chunk, keeps file names unique across batches
     Returns:
         List of (audio_path, start, end)
     """
     os.makedirs(output_dir, exist_ok=True)
-    results = []
+    semaphore = _get_semaphore("tts", TTS_CONCURRENCY)
+
+    if not target_language and chunks:
+        # One detection for the whole batch instead of one HTTP round-trip per chunk
+        target_language = await _detect_or_default(" ".join(" ".join(chunk["texts"])[:80] for chunk in chunks))
+    fit_semaphore = _get_semaphore("speed_fit", SPEED_FIT_CONCURRENCY)
 
-    for idx, chunk in enumerate(chunks):
+    async def _synthesize(idx, chunk):
         try:
             # Combine all phrases in the chunk and clean brackets
             full_text = " ".join(chunk["texts"])
             # Remove surrounding square brackets
-            full_text = full_text.strip('[]')  # <-- ADD THIS LINE
+            full_text = full_text.strip('[]')
             duration = chunk["end"] - chunk["start"]
-            
+
             output_path = os.path.join(
                 output_dir,
                 f"chunk_{idx}_{chunk['start']:.2f}-{chunk['end']:.2f}.wav"
             )
 
-            success = await text_to_speech(
-                text=full_text,
-                output_audio_path=output_path,
-                target_language=target_language,
-                duration=duration
-            )
-            
+            async with semaphore:
+                success = await text_to_speech(
+                    text=full_text,
+                    output_audio_path=output_path,
+                    target_language=target_language
+                )
+
             if success:
-                results.append((output_path, chunk["start"], chunk["end"]))
+                # Fit to the cue after releasing the TTS slot so fits overlap further syntheses
+                if duration > 0:
+                    async with fit_semaphore:
+                        await adjust_audio_speed(output_path, duration)
+                return (output_path, chunk["start"], chunk["end"])
 
         except Exception as e:
-            print(f"⚠️ Failed to generate TTS for chunk {idx}: {e}")
+            logger.warning(f"⚠️ Failed to generate TTS for chunk {idx}: {e}")
+        return None
 
-    return results
+    # gather() keeps submission order, so results line up with the subtitle cues
+    results = await asyncio.gather(*[_synthesize(idx, chunk) for idx, chunk in enumerate(chunks, start_index)])
+    return [result for result in results if result]
 
 # Modified text_to_speech function
 async def text_to_speech(text, output_audio_path, target_language=None, duration=None, max_retries=3):
@@ -89,84 +181,107 @@ async def text_to_speech(text, output_audio_path, target_language=None, duration
         if not os.path.exists(SPEAKER_WAV):
             raise FileNotFoundError(f"❌ Speaker WAV file not found: {SPEAKER_WAV}")
 
-        detected_lang = target_language if target_language else await detect_language(cleaned_text)
+        detected_lang = target_language if target_language else await _detect_or_default(cleaned_text)
         coqui_lang = LANGUAGE_MAP.get(detected_lang.lower(), "en")
 
-        command = [
-            "tts",
-            "--model_name", "tts_models/multilingual/multi-dataset/xtts_v2",
-            "--text", cleaned_text,
-            "--out_path", output_audio_path,
-            "--speaker_wav", SPEAKER_WAV,
-            "--language_idx", coqui_lang
-        ]
-
-        if torch.cuda.is_available():
-            command += ["--use_cuda", "true"]
-
-        # Generate initial TTS without speed adjustment
-        for attempt in range(max_retries):
-            try:
-                print(f"🔊 TTS attempt {attempt + 1} for: {cleaned_text[:50]}...")
-                
-                process = await asyncio.create_subprocess_exec(
-                    *command,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
-                
-                stdout, stderr = await process.communicate()
-                
-                if process.returncode == 0 and os.path.exists(output_audio_path):
-                    # Post-process speed adjustment if duration is specified
-                    if duration and duration > 0:
-                        adjust_audio_speed(output_audio_path, duration)
-                    print(f"✅ TTS successful: {output_audio_path}")
-                    return True
-                
-                print(f"❌ TTS error: {stderr.decode().strip()}")
-                
-            except Exception as e:
-                print(f"⚠️ TTS attempt {attempt + 1} failed: {str(e)}")
-                if attempt == max_retries - 1:
-                    raise RuntimeError(f"❌ TTS failed after {max_retries} attempts")
-                await asyncio.sleep(1)
-
-        return False
+        # Identical (language, voice, text) requests share one synthesis; the voice is keyed
+        # by content so replacing sample_voice.wav does not keep serving the old voice
+        speaker_digest = _speaker_digest or await asyncio.to_thread(_speaker_wav_digest)
+        cache_key = disk_cache.cache_key(coqui_lang, speaker_digest, cleaned_text)
+        async with disk_cache.key_lock(cache_key):
+            return await _synthesize_cached(
+                cache_key, cleaned_text, coqui_lang, output_audio_path, duration, max_retries
+            )
     except Exception as e:
-        print(f"❌ Final TTS error: {str(e)}")
+        logger.error(f"❌ Final TTS error: {str(e)}")
         return False
 
-def adjust_audio_speed(file_path, target_duration):
-    """Adjust audio speed with safety checks"""
+async def _synthesize_cached(cache_key, cleaned_text, coqui_lang, output_audio_path, duration, max_retries):
+    """Serve TTS from the on-disk cache, or synthesize with the shared model and cache the raw output"""
+    if await asyncio.to_thread(disk_cache.fetch_file, "tts", cache_key, ".wav", output_audio_path):
+        if duration and duration > 0:
+            await adjust_audio_speed(output_audio_path, duration)
+        logger.info(f"✅ TTS cache hit: {output_audio_path}")
+        return True
+
+    model = await get_tts_model()
+
+    # Generate initial TTS without speed adjustment
+    for attempt in range(max_retries):
+        try:
+            logger.debug(f"🔊 TTS attempt {attempt + 1} for: {cleaned_text[:50]}...")
+            
+            # In-process synthesis: no CLI spawn, model load or speaker re-encode per chunk
+            await asyncio.to_thread(_synthesize_to_file, model, cleaned_text, coqui_lang, output_audio_path)
+            
+            if os.path.exists(output_audio_path):
+                # Cache the raw synthesis; the speed fit depends on each cue's slot
+                await asyncio.to_thread(disk_cache.store_file, "tts", cache_key, ".wav", output_audio_path)
+
+                # Post-process speed adjustment if duration is specified
+                if duration and duration > 0:
+                    await adjust_audio_speed(output_audio_path, duration)
+                logger.info(f"✅ TTS successful: {output_audio_path}")
+                return True
+            
+            logger.error(f"❌ TTS error: no audio written to {output_audio_path}")
+            
+        except Exception as e:
+            logger.warning(f"⚠️ TTS attempt {attempt + 1} failed: {str(e)}")
+            if attempt == max_retries - 1:
+                raise RuntimeError(f"❌ TTS failed after {max_retries} attempts")
+            await asyncio.sleep(1)
+
+    return False
+
+async def adjust_audio_speed(file_path, target_duration):
+    """Adjust audio speed with safety checks (FFmpeg rubberband or atempo, in place)"""
+    tmp_path = None
     try:
         if target_duration <= 0.1:  # Minimum 100ms duration
-            print("⏩ Skipping invalid target duration")
+            logger.warning("⏩ Skipping invalid target duration")
             return
 
-        audio = AudioSegment.from_file(file_path)
-        current_duration = len(audio) / 1000
+        # Header read only: no decode just to learn the length
+        current_duration = sf.info(file_path).duration
         
         if current_duration <= 0.1:
-            print("⏩ Invalid audio duration")
+            logger.warning("⏩ Invalid audio duration")
             return
 
         speed_factor = current_duration / target_duration
         speed_factor = max(0.5, min(2.0, speed_factor))
 
-        # Preserve audio characteristics
-        adjusted = audio.speedup(
-            playback_speed=speed_factor,
-            chunk_size=150,  # Smoother speed adjustment
-            crossfade=25     # Prevent audio artifacts
+        if abs(speed_factor - 1.0) < TEMPO_TOLERANCE:
+            # Inaudible change: skip the stretch and re-export; the mixer trims any overhang
+            logger.info(f"⏩ {os.path.basename(file_path)} already fits ({speed_factor:.2f}x)")
+            return
+
+        # Rubber Band when FFmpeg has it, else atempo (both keep pitch), plus -t for the exact
+        # duration, in one pass; rounding lets similar ratios share a cached filter string
+        use_rubberband = await asyncio.to_thread(has_rubberband)
+        audio_filter = tempo_filter(round(speed_factor, 3), use_rubberband)
+        root, ext = os.path.splitext(file_path)
+        tmp_path = f"{root}.tempo{ext}"
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-y", "-nostdin", "-i", file_path,
+            "-af", audio_filter,
+            "-t", f"{target_duration:.3f}",
+            tmp_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
         )
-        
-        # Ensure exact duration
-        if len(adjusted) > target_duration * 1000:
-            adjusted = adjusted[:int(target_duration * 1000)]
-            
-        adjusted.export(file_path, format="wav")
-        print(f"⚡ Adjusted {os.path.basename(file_path)} by {speed_factor:.2f}x")
+        _, stderr = await process.communicate()
+
+        if process.returncode != 0:
+            logger.warning(f"⚠️ Speed adjustment failed: {stderr[-1024:].decode('utf-8', 'replace').strip()}")
+            return
+
+        os.replace(tmp_path, file_path)
+        logger.info(f"⚡ Adjusted {os.path.basename(file_path)} by {speed_factor:.2f}x")
 
     except Exception as e:
-        print(f"⚠️ Speed adjustment failed: {str(e)}")
\ No newline at end of file
+        logger.warning(f"⚠️ Speed adjustment failed: {str(e)}")
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
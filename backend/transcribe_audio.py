@@ -1,41 +1,140 @@
-import whisper
 import asyncio
 import os
+import logging
+import threading
+import ctranslate2
+import numpy as np
+from faster_whisper import WhisperModel
+
+logger = logging.getLogger(__name__)
 
 WHISPER_MODEL = "base"
+WARMUP_SAMPLES = 16000  # One second of 16 kHz silence
+
+# Decoding knobs: greedy search by default for throughput, raise for accuracy
+WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", "1"))
+WHISPER_BEST_OF = int(os.getenv("WHISPER_BEST_OF", "1"))
+WHISPER_TEMPERATURE = float(os.getenv("WHISPER_TEMPERATURE", "0"))
+WHISPER_MIN_SILENCE_MS = int(os.getenv("WHISPER_MIN_SILENCE_MS", "500"))
+# Inference workers sharing the one loaded model; >1 lets concurrent requests transcribe in parallel
+WHISPER_NUM_WORKERS = int(os.getenv("WHISPER_NUM_WORKERS", "1"))
 _model = None  # Lazy-load model only when needed
+_model_lock = None  # Concurrent first requests must not load it twice; created on the running loop
+
+def _load_model():
+    """Loads faster-whisper with int8 weights (int8_float16 on GPU, int8 on CPU)."""
+    if ctranslate2.get_cuda_device_count() > 0:
+        model = WhisperModel(
+            WHISPER_MODEL, device="cuda", compute_type="int8_float16", num_workers=WHISPER_NUM_WORKERS
+        )
+    else:
+        model = WhisperModel(
+            WHISPER_MODEL, device="cpu", compute_type="int8", num_workers=WHISPER_NUM_WORKERS
+        )
+
+    # Warm up encoder/decoder kernels and allocator on a short silent clip
+    segments, _info = model.transcribe(np.zeros(WARMUP_SAMPLES, dtype=np.float32), beam_size=1)
+    for _segment in segments:
+        pass
+    return model
 
 async def get_model():
     """Loads the Whisper model asynchronously if not already loaded."""
-    global _model
+    global _model, _model_lock
     if _model is None:
-        print(f"⏳ Loading Whisper-{WHISPER_MODEL} model...")
-        _model = await asyncio.to_thread(whisper.load_model, WHISPER_MODEL)
-        print(f"✅ Whisper-{WHISPER_MODEL} model loaded.")
+        if _model_lock is None:
+            _model_lock = asyncio.Lock()
+        async with _model_lock:
+            if _model is None:
+                logger.info(f"⏳ Loading Whisper-{WHISPER_MODEL} model...")
+                _model = await asyncio.to_thread(_load_model)
+                logger.info(f"✅ Whisper-{WHISPER_MODEL} model loaded.")
     return _model
 
-async def transcribe_audio(audio_path):
+def _run_model(model, audio):
+    """Starts a transcription; faster-whisper decodes lazily as the segments are iterated."""
+    return model.transcribe(
+        audio,
+        beam_size=WHISPER_BEAM_SIZE,
+        best_of=WHISPER_BEST_OF,
+        temperature=WHISPER_TEMPERATURE,  # A scalar disables the temperature fallback ladder
+        vad_filter=True,  # Skip silence before it reaches the decoder
+        vad_parameters={"min_silence_duration_ms": WHISPER_MIN_SILENCE_MS},
+        condition_on_previous_text=False  # Better sentence separation
+    )
+
+def _segment_dict(segment):
+    return {
+        "start": segment.start,
+        "end": segment.end,
+        "text": segment.text.strip()
+    }
+
+def _transcribe(model, audio):
+    """Runs the transcription and drains faster-whisper's lazy segment generator."""
+    segments, info = _run_model(model, audio)
+
+    # Return full sentences with their timestamps
+    return [_segment_dict(segment) for segment in segments], info.language
+
+def _stream_segments(model, audio, emit, stop):
+    """Drains the segment generator in a worker thread, emitting each segment as it is decoded."""
+    segments, info = _run_model(model, audio)
+    for segment in segments:
+        if stop.is_set():
+            break
+        emit((info.language, _segment_dict(segment)))
+
+async def stream_transcription(audio):
+    """
+    Yields (language, segment) pairs as Whisper decodes them.
+
+    Lets translation and TTS start on the first sentences while the rest of
+    the file is still being transcribed. Errors are raised to the consumer.
+    """
+    model = await get_model()
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stop = threading.Event()
+    done = object()
+
+    def emit(item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    async def produce():
+        try:
+            await asyncio.to_thread(_stream_segments, model, audio, emit, stop)
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            # Queued after every emitted segment: emits are scheduled before to_thread resolves
+            queue.put_nowait(done)
+
+    producer = asyncio.ensure_future(produce())
     try:
-        model = await get_model()
-        result = await asyncio.to_thread(
-            model.transcribe,
-            audio_path,
-            # These parameters help with sentence segmentation
-            word_timestamps=False,  # Disable word-level timestamps
-            verbose=False,
-            condition_on_previous_text=False  # Better sentence separation
-        )
+        while True:
+            item = await queue.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Consumer gave up early: let the worker stop at the next segment
+        stop.set()
+        await producer
+
+async def transcribe_audio(audio):
+    """Transcribes an audio file path or a 16 kHz mono float32 sample array."""
+    segments, _language = await transcribe_audio_with_language(audio)
+    return segments
 
-        # Return full sentences with their timestamps
-        return [
-            {
-                "start": segment["start"],
-                "end": segment["end"],
-                "text": segment["text"].strip()
-            }
-            for segment in result.get("segments", [])
-        ]
+async def transcribe_audio_with_language(audio):
+    """Like transcribe_audio, but also returns Whisper's detected language code (or None)."""
+    try:
+        model = await get_model()
+        return await asyncio.to_thread(_transcribe, model, audio)
 
     except Exception as e:
-        print(f"Transcription error: {e}")
-        return []
\ No newline at end of file
+        logger.error(f"Transcription error: {e}")
+        return [], None
@@ -1,114 +1,526 @@
 import httpx
 import asyncio
+import hashlib
 import os
 import logging
+import orjson
+import random
 import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+import disk_cache
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 LIBRETRANSLATE_URL = os.getenv("LIBRETRANSLATE_URL", "http://127.0.0.1:5000/translate")
+LIBRETRANSLATE_DETECT_URL = os.getenv(
+    "LIBRETRANSLATE_DETECT_URL", LIBRETRANSLATE_URL.rsplit("/", 1)[0] + "/detect"
+)
 MAX_TEXT_LENGTH = 500
+TRANSLATE_BATCH_SIZE = 32  # Texts per LibreTranslate request
+MAX_CONCURRENT_BATCHES = 8  # In-flight requests per translation call
 RETRY_ATTEMPTS = 3
 TIMEOUT = 15.0
+RETRY_BACKOFF = 0.25  # Base delay in seconds, doubled per attempt (plus up to 1 s of jitter)
+TRANSLATION_CACHE_SIZE = 10_000  # Bounded (source, target, text) -> translation entries
+DETECT_CACHE_SIZE = 1024  # Detected languages keyed by a digest of the sample prefix
+DETECT_PREFIX_CHARS = 200
+CLEAN_INLINE_LIMIT = 256  # Leaves cleaned on the event loop; larger trees go to a worker thread
+
+FAILURE_CACHE_TTL = 60.0  # Seconds an identical failed call fails fast
+FAILURE_CACHE_SIZE = 1024
+
+_translation_cache = OrderedDict()  # The process's one translation LRU, shared with generate_subtitles
+_detect_cache = OrderedDict()
+_failure_cache = {}  # (digest of texts, source, target) -> (monotonic time, (error type, message, status))
+
+# Allow Hindi, Latin letters, numbers, and basic punctuation; compiled once, not per leaf
+_CLEAN_RE = re.compile(r"[^\u0900-\u097F\w\s.,!?।0-9]")
+_WS_RE = re.compile(r"\s+")
+# Same filter for pure-ASCII text as a str.translate deletion table (a C loop, no regex engine)
+_ASCII_DELETE = {i: None for i in range(128) if _CLEAN_RE.match(chr(i))}
+
+# Raw leaves with no letters at all ("12:34", "100%", "...", "") come back exactly as written
+_UNTRANSLATABLE_RE = re.compile(r"[\d\s\W]*")
+
+# Short texts are packed into one payload around a sentinel that MT leaves alone
+PACK_SENTINEL = "⟂⟂⟂"
+PACK_SEPARATOR = f"\n{PACK_SENTINEL}\n"
+
+# Long texts are split after sentence-ending punctuation (Latin and Devanagari)
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?।])\s+")
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+@dataclass
+class TranslationResult:
+    """What translate_text returns; translated_text mirrors the input's nesting"""
+    # Explicit slots (not slots=True) so this still runs on Python 3.9
+    __slots__ = ("translated_text", "target_lang", "source_lang")
+    translated_text: Any
+    target_lang: str
+    source_lang: str
+
+    def __getitem__(self, key):
+        """Dict-style access for callers written against the old dict result"""
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+class TranslationError(Exception):
+    """Base class for translation failures"""
+
+class TranslationServerError(TranslationError):
+    """LibreTranslate stayed unavailable or kept replying garbage through every retry"""
+
+class TranslationClientError(TranslationError):
+    """LibreTranslate rejected the request itself (4xx); retrying cannot help"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+# Shared client: keep-alive connections are reused across calls and retries
+_client = httpx.AsyncClient(
+    timeout=TIMEOUT,
+    http2=True,
+    # HTTP/2 multiplexes concurrent translations; the cap bounds sockets under bursts
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+)
+
+async def close_client():
+    """Close the shared LibreTranslate client (call on application shutdown)."""
+    await _client.aclose()
+
+def _filter_text(text):
+    """Drop disallowed characters and collapse whitespace"""
+    filtered = text.translate(_ASCII_DELETE) if text.isascii() else _CLEAN_RE.sub('', text)
+    # Normalize spaces and remove leading/trailing spaces
+    return _WS_RE.sub(' ', filtered).strip()
 
 def clean_text(text):
     """Clean text while preserving essential characters and content"""
-    # Allow Hindi, Latin letters, numbers, and basic punctuation
-    allowed_chars = r"[\u0900-\u097F\w\s.,!?।0-9]"
-    cleaned = re.sub(fr"[^{allowed_chars}]", '', str(text))
-    
-    # Normalize spaces and remove leading/trailing spaces
-    cleaned = ' '.join(cleaned.split())
+    text = str(text)
+    cleaned = _filter_text(text)
     
     # Preserve original if cleaning removes all meaningful content
-    if len(cleaned.strip()) < 1:
-        return text.strip()
-    return cleaned
+    return cleaned or text.strip()
+
+def split_text(text):
+    """Greedily pack whole sentences into pieces of at most MAX_TEXT_LENGTH characters"""
+    if len(text) <= MAX_TEXT_LENGTH:
+        return [text]
+
+    pieces = []
+    current = ""
+    for sentence in _SENTENCE_BOUNDARY.split(text):
+        # A single over-long sentence can only be cut mid-sentence
+        while len(sentence) > MAX_TEXT_LENGTH:
+            if current:
+                pieces.append(current)
+                current = ""
+            pieces.append(sentence[:MAX_TEXT_LENGTH])
+            sentence = sentence[MAX_TEXT_LENGTH:]
+        if not sentence:
+            continue
+        if current and len(current) + 1 + len(sentence) > MAX_TEXT_LENGTH:
+            pieces.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        pieces.append(current)
+    return pieces
+
+def _prepare_leaf(original):
+    # One filter pass; the keep-original rule also covers text cleaned to nothing
+    cleaned = _filter_text(original)
+    # Preserve original if cleaning removes too much
+    return cleaned if len(cleaned) > len(original)*0.5 else original
+
+def flatten_text(data):
+    """Flatten a (nested) list of strings iteratively.
+
+    Returns the prepared leaves in depth-first order and a template with the
+    same nesting whose leaves are indices into that flat list.
+    """
+    flat_list, structure = _walk_leaves(data)
+    return prepare_leaves(flat_list), structure
+
+def _walk_leaves(data):
+    """The walk half of flatten_text: raw str leaves plus the index template"""
+    if not isinstance(data, list):
+        return [str(data)], 0
+
+    flat_list = []
+    structure = []
+    stack = [(iter(data), structure)]
+    while stack:
+        items, template = stack[-1]
+        for item in items:
+            if isinstance(item, list):
+                child = []
+                template.append(child)
+                stack.append((iter(item), child))
+                break
+            template.append(len(flat_list))
+            flat_list.append(str(item))
+        else:
+            stack.pop()
+    return flat_list, structure
+
+def prepare_leaves(flat_list):
+    """The cleaning half of flatten_text: one flat pass that handles each distinct leaf once"""
+    prepared = {leaf: _prepare_leaf(leaf) for leaf in set(flat_list)}
+    return [prepared[leaf] for leaf in flat_list]
+
+def restore_structure(flat_translations, structure):
+    """Rebuild the nesting recorded by flatten_text around the translated leaves."""
+    if not isinstance(structure, list):
+        return flat_translations[structure]
+
+    restored = []
+    stack = [(iter(structure), restored)]
+    while stack:
+        items, target = stack[-1]
+        for item in items:
+            if isinstance(item, list):
+                child = []
+                target.append(child)
+                stack.append((iter(item), child))
+                break
+            target.append(flat_translations[item])
+        else:
+            stack.pop()
+    return restored
+
+def _recent_failure(key):
+    """The error of an identical call that failed within FAILURE_CACHE_TTL, if any"""
+    entry = _failure_cache.get(key)
+    if entry is None:
+        return None
+    failed_at, (error_type, message, status_code) = entry
+    if time.monotonic() - failed_at >= FAILURE_CACHE_TTL:
+        del _failure_cache[key]
+        return None
+    # A fresh instance per raise: re-raising one stored exception keeps growing its traceback
+    if status_code is not None:
+        return error_type(message, status_code)
+    return error_type(message)
+
+def _remember_failure(key, error):
+    now = time.monotonic()
+    _failure_cache.pop(key, None)  # Re-insert so insertion order stays oldest-first
+    _failure_cache[key] = (now, (type(error), str(error), getattr(error, "status_code", None)))
+    if len(_failure_cache) > FAILURE_CACHE_SIZE:
+        # Opportunistic sweep: expired entries first, then the oldest
+        for stale in [k for k, (failed_at, _) in _failure_cache.items() if now - failed_at >= FAILURE_CACHE_TTL]:
+            del _failure_cache[stale]
+        while len(_failure_cache) > FAILURE_CACHE_SIZE:
+            del _failure_cache[next(iter(_failure_cache))]
+
+def _trim_translation_cache():
+    while len(_translation_cache) > TRANSLATION_CACHE_SIZE:
+        _translation_cache.popitem(last=False)
+
+async def lookup_translations(texts, target_lang, source_lang):
+    """
+    Looks texts up in the process-local LRU, then in the on-disk cache.
+
+    Returns the hits as {text: translation}, the distinct texts found in
+    neither tier, and {text: disk cache key} for those misses.
+    """
+    hits = {}
+    pending = []
+    for text in dict.fromkeys(texts):
+        cached = _translation_cache.get((source_lang, target_lang, text))
+        if cached is not None:
+            _translation_cache.move_to_end((source_lang, target_lang, text))
+            hits[text] = cached
+        else:
+            pending.append(text)
+    if not pending:
+        return hits, [], {}
+
+    # Second tier: the on-disk cache survives restarts and is shared by workers
+    keys = {text: disk_cache.cache_key(source_lang, target_lang, text) for text in pending}
+    stored = await asyncio.to_thread(disk_cache.load_json_many, "translations", keys.values())
+    misses = []
+    for text in pending:
+        if keys[text] in stored:
+            hits[text] = stored[keys[text]]
+            _translation_cache[(source_lang, target_lang, text)] = stored[keys[text]]
+        else:
+            misses.append(text)
+    _trim_translation_cache()
+    return hits, misses, {text: keys[text] for text in misses}
+
+async def store_translations(translations, keys, target_lang, source_lang):
+    """Records fresh translations ({text: translation}) in both cache tiers"""
+    if not translations:
+        return
+    for text, translation in translations.items():
+        _translation_cache[(source_lang, target_lang, text)] = translation
+    _trim_translation_cache()
+    await asyncio.to_thread(
+        disk_cache.store_json_many, "translations",
+        {keys[text]: translation for text, translation in translations.items()}
+    )
+
+async def detect_language(text):
+    """
+    Detects the language of a text sample once (memoized on its prefix).
+
+    Callers translating a stream in one language should detect it from the
+    first lines and pass the code as source_lang to every translate_text call,
+    instead of leaving "auto" to re-run detection server-side for each request.
+    """
+    key = hashlib.blake2b(text[:DETECT_PREFIX_CHARS].encode("utf-8"), digest_size=8).digest()
+    if key in _detect_cache:
+        _detect_cache.move_to_end(key)
+        return _detect_cache[key]
+
+    response = await _client.post(
+        LIBRETRANSLATE_DETECT_URL,
+        content=orjson.dumps({"q": text}),
+        headers=JSON_HEADERS
+    )
+    response.raise_for_status()
+    result = orjson.loads(response.content)
+    if isinstance(result, list) and result:
+        result = result[0]  # Candidates come back best first
+    if not isinstance(result, dict) or "language" not in result:
+        raise ValueError(f"🚨 Unexpected detection response: {result}")
+
+    _detect_cache[key] = result["language"]
+    if len(_detect_cache) > DETECT_CACHE_SIZE:
+        _detect_cache.popitem(last=False)
+    return result["language"]
 
 async def translate_text(text, target_lang, source_lang="auto"):
     """
     Translates text using LibreTranslate with careful content preservation.
+
+    Accepts a single string or a (nested) list of strings; the result mirrors
+    the input structure. Leaves found in the process-local LRU or the on-disk
+    cache are not sent; the rest go out in concurrent batched requests.
+
+    For a stream of subtitles, call detect_language once and pass its result
+    as source_lang; "auto" makes the server identify every request again.
     """
     if not text:
         raise ValueError("❌ Input text is empty.")
 
-    def flatten_text(data):
-        structure = []
-        flat_list = []
-        
-        def recurse(sub_data):
-            if isinstance(sub_data, list):
-                sub_structure = []
-                for item in sub_data:
-                    sub_structure.append(recurse(item))
-                structure.append(sub_structure)
-            else:
-                original = str(sub_data)
-                cleaned = clean_text(original)
-                # Preserve original if cleaning removes too much
-                final_text = cleaned if len(cleaned) > len(original)*0.5 else original
-                sub_structure = len(flat_list)
-                flat_list.append(final_text)
-                structure.append(sub_structure)
-            return sub_structure
-
-        recurse(data)
-        return flat_list, structure
-
-    def restore_structure(flat_translations, structure):
-        def recurse(struct):
-            if isinstance(struct, list):
-                return [recurse(sub_struct) for sub_struct in struct]
-            return flat_translations[struct]
-        return recurse(structure)
-
-    text_list, structure = flatten_text(text)
-
-    # Split long texts into smaller chunks
+    raw_list, structure = _walk_leaves(text)
+    # Judged on the raw leaf: cleaning would strip the ":" of "12:34" before it could pass through
+    untranslatable = [bool(_UNTRANSLATABLE_RE.fullmatch(leaf)) for leaf in raw_list]
+    if len(raw_list) > CLEAN_INLINE_LIMIT:
+        # Large trees are cleaned on a worker thread so the event loop keeps serving
+        text_list = await asyncio.to_thread(prepare_leaves, raw_list)
+    else:
+        text_list = prepare_leaves(raw_list)
+    if source_lang == "auto" and len(text_list) > 1:
+        logger.debug("source_lang='auto' for a multi-text call; detect_language once and pass it instead")
+
+    translations, misses, keys = await lookup_translations(
+        [leaf for leaf, skip in zip(text_list, untranslatable) if not skip], target_lang, source_lang
+    )
+    if misses:
+        # An identical call that just failed fails again at once instead of re-paying the retries
+        failure_key = (
+            hashlib.blake2b("\x00".join(misses).encode("utf-8"), digest_size=16).digest(),
+            source_lang,
+            target_lang
+        )
+        failure = _recent_failure(failure_key)
+        if failure is not None:
+            raise failure
+        try:
+            translated = await translate_uncached(misses, target_lang, source_lang)
+        except TranslationError as e:
+            _remember_failure(failure_key, e)
+            raise
+        new_entries = dict(zip(misses, translated))
+        translations.update(new_entries)
+        await store_translations(new_entries, keys, target_lang, source_lang)
+
+    flat_translations = [
+        raw if skip else translations[leaf]
+        for raw, leaf, skip in zip(raw_list, text_list, untranslatable)
+    ]
+    reconstructed_translations = restore_structure(flat_translations, structure)
+
+    return TranslationResult(reconstructed_translations, target_lang, source_lang)
+
+async def translate_uncached(texts, target_lang, source_lang, retries=RETRY_ATTEMPTS, fallback_to_source=False):
+    """
+    Translate texts through LibreTranslate, without consulting the caches.
+
+    With fallback_to_source, texts whose batch still fails after the retries
+    come back as None instead of raising.
+    """
+    # Split long texts on sentence boundaries; piece_counts maps pieces back to texts
     chunked_texts = []
-    for chunk in text_list:
-        if len(chunk) > MAX_TEXT_LENGTH:
-            chunked_texts.extend([chunk[i:i+MAX_TEXT_LENGTH] for i in range(0, len(chunk), MAX_TEXT_LENGTH)])
+    piece_counts = []
+    for chunk in texts:
+        pieces = split_text(chunk)
+        chunked_texts.extend(pieces)
+        piece_counts.append(len(pieces))
+
+    # Identical pieces (a line repeated inside long texts) are translated once
+    unique_pieces = list(dict.fromkeys(chunked_texts))
+
+    # Short pieces travel together: fewer items means less per-item overhead server-side
+    packed, spans = pack_texts(unique_pieces)
+    packed_translations = await _post_batches(packed, target_lang, source_lang, retries, fallback_to_source)
+
+    unique_translations = [None] * len(unique_pieces)
+    unpacked = []
+    for translation, span in zip(packed_translations, spans):
+        if translation is None:
+            continue  # Failed batch under fallback_to_source: its pieces stay None
+        if len(span) == 1:
+            unique_translations[span[0]] = translation
+            continue
+        parts = translation.split(PACK_SENTINEL)
+        if len(parts) != len(span):
+            # The sentinel did not survive translation: send these pieces one by one
+            unpacked.extend(span)
+            continue
+        for index, part in zip(span, parts):
+            unique_translations[index] = part.strip()
+
+    if unpacked:
+        logger.warning("⚠️ Re-sending %d packed texts individually", len(unpacked))
+        retranslated = await _post_batches(
+            [unique_pieces[i] for i in unpacked], target_lang, source_lang, retries, fallback_to_source
+        )
+        for index, translation in zip(unpacked, retranslated):
+            unique_translations[index] = translation
+
+    piece_translations = dict(zip(unique_pieces, unique_translations))
+    translated_chunks = [piece_translations[piece] for piece in chunked_texts]
+
+    # Re-join texts that were split into pieces so indices match texts again
+    flat_translations = []
+    chunk_index = 0
+    for count in piece_counts:
+        parts = translated_chunks[chunk_index:chunk_index + count]
+        flat_translations.append(None if None in parts else " ".join(parts))
+        chunk_index += count
+
+    return flat_translations
+
+def pack_texts(texts):
+    """
+    Greedily join consecutive short texts with PACK_SEPARATOR, up to MAX_TEXT_LENGTH each.
+
+    Returns the packed payloads and, for each, the indices of the texts it holds.
+    """
+    packed = []
+    spans = []
+    for index, text in enumerate(texts):
+        if (
+            packed
+            and PACK_SENTINEL not in text
+            and PACK_SENTINEL not in texts[spans[-1][-1]]
+            and len(packed[-1]) + len(PACK_SEPARATOR) + len(text) <= MAX_TEXT_LENGTH
+        ):
+            packed[-1] += PACK_SEPARATOR + text
+            spans[-1].append(index)
         else:
-            chunked_texts.append(chunk)
-
-    translated_chunks = []
-
-    for attempt in range(RETRY_ATTEMPTS):
-        async with httpx.AsyncClient(timeout=TIMEOUT) as client:
-            try:
-                response = await client.post(
-                    LIBRETRANSLATE_URL,
-                    json={"q": chunked_texts, "source": source_lang, "target": target_lang}
-                )
-                response.raise_for_status()
-                response_data = response.json()
-
-                if isinstance(response_data, list):
-                    translated_chunks = [item.get("translatedText", "") for item in response_data]
-                elif isinstance(response_data, dict) and "translatedText" in response_data:
-                    translated_chunks = [response_data["translatedText"]]
-                else:
-                    raise ValueError(f"🚨 Unexpected API response: {response_data}")
+            packed.append(text)
+            spans.append([index])
+    return packed, spans
 
-                break
+async def _post_batches(texts, target_lang, source_lang, retries=RETRY_ATTEMPTS, fallback_to_source=False):
+    """Translate texts in fixed-size batches posted concurrently over the shared client"""
+    # A failed batch retries on its own instead of resending everything
+    batches = [texts[i:i+TRANSLATE_BATCH_SIZE] for i in range(0, len(texts), TRANSLATE_BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+
+    async def _bounded(batch):
+        async with semaphore:
+            return await post_translation_batch(batch, target_lang, source_lang, retries)
+
+    results = await asyncio.gather(*[_bounded(batch) for batch in batches], return_exceptions=True)
+    translations = []
+    for batch, result in zip(batches, results):
+        if isinstance(result, BaseException):
+            if not fallback_to_source:
+                raise result
+            logger.warning("⚠️ Keeping %d texts untranslated: %s", len(batch), result)
+            result = [None] * len(batch)
+        translations.extend(result)
+    return translations
+
+def _unwrap_str(value):
+    """Reduce one translation entry (str, {"translatedText": ...} or nested list) to a str"""
+    if isinstance(value, dict):
+        value = value.get("translatedText", "")
+    while isinstance(value, list) and value:
+        value = value[0]
+    if not isinstance(value, str):
+        raise ValueError(f"Expected str, got {type(value).__name__}")
+    return value
+
+async def post_translation_batch(batch, target_lang, source_lang, retries=RETRY_ATTEMPTS):
+    """
+    POST one batch of texts to LibreTranslate, retrying transient failures.
+
+    Raises TranslationClientError at once when the request is rejected (4xx
+    other than 429) and TranslationServerError once every retry is spent.
+    """
+    for attempt in range(retries):
+        try:
+            # orjson (C) instead of httpx's stdlib json on both legs of large batches
+            response = await _client.post(
+                LIBRETRANSLATE_URL,
+                content=orjson.dumps({"q": batch, "source": source_lang, "target": target_lang}),
+                headers=JSON_HEADERS
+            )
+            response.raise_for_status()
+            response_data = orjson.loads(response.content)
+
+            if isinstance(response_data, list):
+                translated_chunks = [_unwrap_str(item) for item in response_data]
+            elif isinstance(response_data, dict) and "translatedText" in response_data:
+                translated = response_data["translatedText"]
+                # A batched "q" list comes back as a list under a single key
+                if not isinstance(translated, list):
+                    translated = [translated]
+                translated_chunks = [_unwrap_str(item) for item in translated]
+            elif isinstance(response_data, dict) and "error" in response_data:
+                raise ValueError(f"🚨 Translation error: {response_data['error']}")
+            else:
+                raise ValueError(f"🚨 Unexpected API response: {response_data}")
+
+            # Batches are re-joined by position, so a short reply is a failure
+            if len(translated_chunks) != len(batch):
+                raise ValueError(f"🚨 Expected {len(batch)} translations, got {len(translated_chunks)}")
+
+            return translated_chunks
 
-            except httpx.HTTPStatusError as http_err:
-                logger.warning(f"🚨 HTTP error (attempt {attempt+1}): {http_err.response.status_code} - {http_err.response.text}")
-            except httpx.RequestError as req_err:
-                logger.warning(f"🚨 Network error (attempt {attempt+1}): {req_err}")
-            except Exception as e:
-                logger.error(f"🚨 Unexpected error: {e}")
+        except httpx.HTTPStatusError as http_err:
+            status = http_err.response.status_code
+            logger.warning("🚨 HTTP error (attempt %d/%d): %s - %s", attempt + 1, retries, status, http_err.response.text)
+            if not _is_retryable_status(status):
+                # A rejected request (bad language, payload too large...) fails the same way again
+                raise TranslationClientError(f"🚨 Translation rejected with HTTP {status}.", status) from http_err
+        except httpx.RequestError as req_err:
+            logger.warning("🚨 Network error (attempt %d/%d): %s", attempt + 1, retries, req_err)
+        except ValueError as e:
+            # Malformed or short reply (orjson.JSONDecodeError is a ValueError too)
+            logger.error("🚨 Unexpected response (attempt %d/%d): %s", attempt + 1, retries, e)
 
-            if attempt == RETRY_ATTEMPTS - 1:
-                raise Exception("🚨 Translation failed after multiple retries.")
+        if attempt < retries - 1:
+            # Back off with jitter so retries from concurrent batches do not arrive in lockstep
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt + random.random())
 
-    reconstructed_translations = restore_structure(translated_chunks, structure)
+    raise TranslationServerError("🚨 Translation failed after multiple retries.")
 
-    return {
-        "translated_text": reconstructed_translations,
-        "target_lang": target_lang,
-        "source_lang": source_lang,
-    }
\ No newline at end of file
+def _is_retryable_status(status):
+    """Server errors and rate limiting are transient; other 4xx responses are not"""
+    return status >= 500 or status == 429